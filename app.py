@@ -3,15 +3,33 @@
 
 import os
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core.exceptions import NotFound
 import fitz  # PyMuPDF
+import zstandard as zstd
+import numpy as np
 from flask import Flask, request, Response, render_template, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt
+from flask_compress import Compress
 from pymongo import MongoClient
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError, WriteError
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
-import json
+from pdf_extract import extract_page_range
+import orjson
 import uuid
+import tempfile
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import atexit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 import datetime
 
 # --- 1. Configuration and Setup ---
@@ -25,52 +43,686 @@ if not api_key:
 if not mongo_uri:
     raise ValueError("MONGO_URI not found in .env file.")
 
-genai.configure(api_key=api_key)
+# The REST transport streams Gemini responses over plain HTTP sockets, which
+# cooperative (gevent) workers can multiplex; the default gRPC transport
+# would block the whole worker while a response is streaming.
+genai.configure(api_key=api_key, transport="rest")
+
+# Upper bound on pages read from an uploaded PDF (0 means no limit).
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "0"))
+# PDFs with at least this many pages are extracted across worker processes.
+PARALLEL_PDF_MIN_PAGES = 8
+# Size of this process's extraction pool. gunicorn_conf.py sets it to 1, as
+# its workers already use every CPU; a standalone run uses all of them.
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", "0")) or os.cpu_count() or 1
+# Approximate memory each worker may spend on PDF prompt contexts.
+PDF_CONTEXT_CACHE_BYTES = int(os.getenv("PDF_CONTEXT_CACHE_MB", "64")) * 1024 * 1024
+# PDFs longer than this are answered from retrieved excerpts; shorter ones
+# are given to Gemini in full (through a context cache when large enough).
+RETRIEVAL_MIN_CHARS = 2_000_000
+RETRIEVAL_CHUNK_CHARS = 4000  # roughly 1000 tokens
+RETRIEVAL_TOP_K = 5
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_BATCH_SIZE = 100
+# zstd level for PDF text stored in MongoDB.
+PDF_TEXT_ZSTD_LEVEL = 3
+# Gemini model for every turn. It is pinned to a version because context
+# caching requires one, and cached and inline turns must use the same model.
+GEMINI_MODEL = "models/gemini-1.5-flash-002"
+# Gemini context caching: the minimum prompt it accepts (32,768 tokens at
+# ~4 characters each), and cache lifetime.
+CONTEXT_CACHE_MIN_CHARS = 32_768 * 4
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+# A cache this close to expiry has its TTL extended before a new turn uses it.
+CONTEXT_CACHE_MARGIN_SECONDS = 5 * 60
+# After a failed cache creation, the PDF is sent inline for this long before
+# creation is tried again.
+CONTEXT_CACHE_RETRY_SECONDS = 6 * 60 * 60
+# Approximate memory each worker may spend on Gemini chat sessions (which
+# hold their own copy of the document when it is sent inline), and how long
+# an idle session is kept.
+CHAT_SESSION_CACHE_BYTES = int(os.getenv("CHAT_SESSION_CACHE_MB", "64")) * 1024 * 1024
+CHAT_SESSION_IDLE_SECONDS = 30 * 60
+
+SYSTEM_PROMPT = "You are a professional AI Tutor. Your expertise is explaining the provided document text. When asked a question, provide a clear, step-by-step answer like a teacher, referencing the document. Format your response using Markdown. If the answer isn't in the document, state that clearly."
+MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_PROMPT)
+
+class ORJSONProvider(JSONProvider):
+    """Serves jsonify() and request.get_json() through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
+# Compress JSON/HTML bodies (e.g. loaded chat histories) but never the
+# text/event-stream responses, where buffering would delay streamed tokens.
+app.config["COMPRESS_MIMETYPES"] = ["application/json", "text/html"]
+app.config["COMPRESS_LEVEL"] = 5
+app.config["COMPRESS_MIN_SIZE"] = 2048
+Compress(app)
+# 10 rounds (2^10 Eksblowfish iterations) keeps login/register around 4x
+# cheaper than the default of 12 at the cost of a smaller brute-force margin.
+# Hashes created with other cost factors still verify.
+app.config["BCRYPT_LOG_ROUNDS"] = 10
 bcrypt = Bcrypt(app)
 
-# --- MongoDB Connection ---
-try:
-    client = MongoClient(mongo_uri)
-    db = client.pdf_tutor_pro # Database name
-    users_collection = db.users # Collection for users
-    chats_collection = db.chats # Collection for chats
-    print("Successfully connected to MongoDB.")
-except Exception as e:
-    print(f"Error connecting to MongoDB: {e}")
+# When app.py is run directly and the extraction pool uses spawn/forkserver
+# (macOS, Linux from Python 3.14), each pool process re-imports this file as
+# __mp_main__. Those processes only need pdf_extract, so they skip MongoDB.
+if __name__ != "__mp_main__":
+    # --- MongoDB Connection ---
+    try:
+        client = MongoClient(
+            mongo_uri,
+            maxPoolSize=200,
+            minPoolSize=10,
+            serverSelectionTimeoutMS=2000,
+            socketTimeoutMS=10000,
+            retryWrites=True
+        )
+        db = client.pdf_tutor_pro # Database name
+        users_collection = db.users # Collection for users
+        chats_collection = db.chats # Collection for chats
+        pdfs_collection = db.pdfs # Extracted PDF text, keyed by content hash
+        print("Successfully connected to MongoDB.")
+    except Exception as e:
+        print(f"Error connecting to MongoDB: {e}")
+
+    # --- MongoDB Indexes ---
+    try:
+        chats_collection.create_index([("user_id", 1), ("timestamp", -1)], name="user_time_idx")
+        # Lets access-denied lookups in handle_chat be answered from the index.
+        chats_collection.create_index([("_id", 1), ("user_id", 1)], name="id_user_idx")
+        # Counts the chats using a PDF stored before reference counting.
+        chats_collection.create_index("pdf_hash", name="pdf_hash_idx")
+        users_collection.create_index("username", unique=True)
+    except Exception as e:
+        print(f"Error creating MongoDB indexes: {e}")
+
+# Background writer for chat history, drained on shutdown.
+_history_writer = ThreadPoolExecutor(max_workers=4)
+atexit.register(_history_writer.shutdown)
+
+# Worker processes for PDF text extraction, which is CPU-bound in MuPDF.
+# Created on first use and replaced if a worker dies (e.g. a PDF that crashes
+# MuPDF), since a broken pool would otherwise fail every later upload.
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool(broken=None):
+    """Returns the extraction pool, replacing it if it is `broken`."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None and _pdf_pool is broken:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_POOL_WORKERS)
+        return _pdf_pool
+
+def _shutdown_pdf_pool():
+    """Stops the extraction pool at exit."""
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown()
+
+atexit.register(_shutdown_pdf_pool)
 
 # --- 2. Helper Functions ---
 
-def extract_pdf_text(pdf_file_bytes):
-    """Extracts text from PDF content in bytes."""
+def extract_pdf_text(pdf_path):
+    """Extracts text from a PDF file on disk."""
     try:
-        pdf_document = fitz.open(stream=pdf_file_bytes, filetype="pdf")
-        text = "".join(page.get_text() for page in pdf_document)
+        pdf_document = fitz.open(pdf_path, filetype="pdf")
+        page_count = pdf_document.page_count
         pdf_document.close()
-        return text
+        if MAX_PDF_PAGES:
+            page_count = min(page_count, MAX_PDF_PAGES)
+        if page_count == 0:
+            return ""
+
+        # Extraction always runs in the process pool so the web worker only
+        # waits on it. PyMuPDF is not thread-safe, so large documents are split
+        # into contiguous page ranges, each read by a separate process.
+        workers = 1 if page_count < PARALLEL_PDF_MIN_PAGES else min(PDF_POOL_WORKERS, page_count)
+        step = -(-page_count // workers)
+        starts = range(0, page_count, step)
+        stops = [min(start + step, page_count) for start in starts]
+        pool = _get_pdf_pool()
+        try:
+            return "".join(pool.map(extract_page_range, repeat(pdf_path), starts, stops))
+        except BrokenProcessPool:
+            # Retry once on a fresh pool; if this PDF kills a worker again, the
+            # pool is replaced once more so later uploads are unaffected.
+            pool = _get_pdf_pool(broken=pool)
+            try:
+                return "".join(pool.map(extract_page_range, repeat(pdf_path), starts, stops))
+            except BrokenProcessPool:
+                _get_pdf_pool(broken=pool)
+                raise
     except Exception as e:
         print(f"CRITICAL ERROR during PDF text extraction: {e}")
         return None
 
-def get_gemini_response_stream(chat_history, user_question, pdf_text):
-    """Gets a streaming response from Gemini."""
-    system_prompt = "You are a professional AI Tutor. Your expertise is explaining the provided document text. When asked a question, provide a clear, step-by-step answer like a teacher, referencing the document. Format your response using Markdown. If the answer isn't in the document, state that clearly."
+def hash_pdf_file(pdf_path):
+    """Returns the SHA-256 hex digest of a PDF file on disk."""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def build_doc_prompt(pdf_text):
+    """Wraps a PDF's text in the prompt that opens every conversation."""
+    return f"DOCUMENT TEXT:\n---\n{pdf_text}\n---"
+
+def chunk_text(text, size=RETRIEVAL_CHUNK_CHARS):
+    """Splits text into chunks of about `size` characters on line boundaries."""
+    chunks, current, length = [], [], 0
+    for line in text.splitlines(keepends=True):
+        for start in range(0, len(line), size):
+            piece = line[start:start + size]
+            if current and length + len(piece) > size:
+                chunks.append("".join(current))
+                current, length = [], 0
+            current.append(piece)
+            length += len(piece)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def embed_texts(texts, task_type):
+    """Returns unit-length Gemini embeddings for a list of texts as a float32 matrix."""
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=texts[start:start + EMBEDDING_BATCH_SIZE],
+            task_type=task_type
+        )
+        vectors.extend(result["embedding"])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def compress_text(text):
+    """Compresses text with zstd for storage in MongoDB."""
+    return zstd.ZstdCompressor(level=PDF_TEXT_ZSTD_LEVEL).compress(text.encode("utf-8"))
+
+def decompress_text(data):
+    """Reverses compress_text."""
+    return zstd.ZstdDecompressor().decompress(data).decode("utf-8")
+
+def build_pdf_context(pdf_text, chunks=None, embeddings=None, pdf_hash=None):
+    """Builds the context used to prompt Gemini about a PDF.
+
+    Documents are sent in full as the opening message (`doc_prompt`), which
+    large stored PDFs move into a Gemini context cache; indexed documents
+    carry their chunks and embeddings for retrieval instead.
+    """
+    pdf_context = {
+        "pdf_hash": pdf_hash,
+        "doc_prompt": None,
+        "chunks": chunks,
+        "embeddings": embeddings,
+        "cache_name": None,
+        "cache_expires_at": 0,
+        "cache_retry_at": 0,
+        "cache_lock": threading.Lock()
+    }
+    if not chunks:
+        pdf_context["doc_prompt"] = build_doc_prompt(pdf_text)
+        pdf_context["chunks"] = pdf_context["embeddings"] = None
+    return pdf_context
+
+def load_pdf_context(pdf):
+    """Builds a PDF's prompt context from its record in the pdfs collection."""
+    # Records written before compression keep their text in the plain "text" field.
+    pdf_text = decompress_text(pdf["text_zstd"]) if "text_zstd" in pdf else pdf["text"]
+    if "chunk_ends" in pdf:
+        starts = [0] + pdf["chunk_ends"][:-1]
+        chunks = [pdf_text[start:end] for start, end in zip(starts, pdf["chunk_ends"])]
+    else:
+        chunks = pdf.get("chunks")
+    if "embeddings_f32" in pdf:
+        embeddings = np.frombuffer(pdf["embeddings_f32"], dtype=np.float32).reshape(-1, pdf["embedding_dim"])
+    elif "embeddings" in pdf:
+        embeddings = np.asarray(pdf["embeddings"], dtype=np.float32)
+    else:
+        embeddings = None
+    pdf_context = build_pdf_context(pdf_text, chunks, embeddings, pdf["_id"])
+    _apply_cache_state(pdf_context, pdf)
+    return pdf_context
+
+def _apply_cache_state(pdf_context, pdf):
+    """Copies the Gemini context cache state of a pdfs record into a context."""
+    pdf_context["cache_name"] = pdf.get("cached_content")
+    pdf_context["cache_expires_at"] = pdf.get("cache_expires_at", 0)
+    pdf_context["cache_retry_at"] = pdf.get("cache_retry_at", 0)
+
+def build_turn_message(pdf_context, user_question):
+    """Returns the message sent to Gemini for a question, with excerpts if needed."""
+    if pdf_context["doc_prompt"] is not None:
+        return user_question
+    question_vector = embed_texts([user_question], "retrieval_query")[0]
+    scores = pdf_context["embeddings"] @ question_vector
+    k = min(RETRIEVAL_TOP_K, len(scores))
+    top = np.sort(np.argpartition(-scores, k - 1)[:k])
+    excerpts = "\n---\n".join(pdf_context["chunks"][i] for i in top)
+    return f"DOCUMENT EXCERPTS:\n---\n{excerpts}\n---\n\n{user_question}"
+
+class SizedLRUCache:
+    """Thread-safe LRU cache bounded by the approximate size of its values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size), least recently used first
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a cached value and marks it as recently used, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def pop(self, key):
+        """Removes and returns a cached value, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._total -= entry[1]
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Stores a value, evicting the least recently used ones to stay in budget."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._total += size
+            while self._total > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total -= evicted_size
+
+    def prune(self, is_stale):
+        """Evicts least recently used entries for as long as `is_stale(value)` holds."""
+        with self._lock:
+            while self._entries:
+                key, (value, size) = next(iter(self._entries.items()))
+                if not is_stale(value):
+                    break
+                del self._entries[key]
+                self._total -= size
+
+def pdf_context_size(pdf_context):
+    """Approximate bytes held by a PDF's prompt context."""
+    if pdf_context["chunks"]:
+        return sum(len(chunk) for chunk in pdf_context["chunks"]) + pdf_context["embeddings"].nbytes
+    return len(pdf_context["doc_prompt"])
+
+_pdf_context_cache = SizedLRUCache(PDF_CONTEXT_CACHE_BYTES)
+
+def cache_pdf_context(pdf_hash, pdf_context):
+    """Stores a PDF's prompt context in the in-process LRU cache."""
+    _pdf_context_cache.put(pdf_hash, pdf_context, pdf_context_size(pdf_context))
+
+def get_pdf_context(pdf_hash):
+    """Returns a stored PDF's prompt context, or None if it has never been uploaded."""
+    pdf_context = _pdf_context_cache.get(pdf_hash)
+    if pdf_context is not None:
+        return pdf_context
+    pdf = pdfs_collection.find_one({"_id": pdf_hash})
+    if not pdf:
+        return None
+    pdf_context = load_pdf_context(pdf)
+    cache_pdf_context(pdf_hash, pdf_context)
+    return pdf_context
+
+def evict_pdf_context(pdf_hash):
+    """Drops a PDF's prompt context from the in-process cache."""
+    _pdf_context_cache.pop(pdf_hash)
+
+def _init_pdf_refs(pdf_hash):
+    """Gives a record stored before reference counting the number of its chats.
+
+    Returns False if the record does not exist.
+    """
+    count = chats_collection.count_documents({"pdf_hash": pdf_hash})
+    result = pdfs_collection.update_one({"_id": pdf_hash, "refs": {"$exists": False}}, {"$set": {"refs": count}})
+    return result.matched_count > 0 or pdfs_collection.find_one({"_id": pdf_hash}, {"_id": 1}) is not None
+
+def acquire_pdf_ref(pdf_hash):
+    """Counts a new chat against a stored PDF before the chat is inserted.
+
+    Returns False if the record is gone (e.g. purged by another worker), in
+    which case the PDF must be stored again.
+    """
+    for _ in range(2):
+        result = pdfs_collection.update_one({"_id": pdf_hash, "refs": {"$exists": True}}, {"$inc": {"refs": 1}})
+        if result.matched_count:
+            return True
+        if not _init_pdf_refs(pdf_hash):
+            return False
+    return False
+
+def release_pdf_ref(pdf_hash):
+    """Uncounts a deleted chat, deleting the PDF and its Gemini cache once unused.
+
+    The delete only matches a record whose count is still zero, so a chat
+    created concurrently keeps its PDF.
+    """
+    if not pdf_hash:
+        return
+    result = pdfs_collection.update_one({"_id": pdf_hash, "refs": {"$exists": True}}, {"$inc": {"refs": -1}})
+    # An older record is counted after its chat was deleted, so there is
+    # nothing to subtract.
+    if not result.matched_count and not _init_pdf_refs(pdf_hash):
+        return
+    pdf = pdfs_collection.find_one_and_delete(
+        {"_id": pdf_hash, "refs": {"$lte": 0}},
+        projection={"cached_content": 1}
+    )
+    if not pdf:
+        return
+    evict_pdf_context(pdf_hash)
+    if pdf.get("cached_content"):
+        try:
+            caching.CachedContent.get(pdf["cached_content"]).delete()
+        except Exception as e:
+            print(f"Error deleting context cache for PDF {pdf_hash}: {e}")
+
+def _is_too_large(error):
+    """True if MongoDB rejected a write for exceeding its 16 MB document limit."""
+    return isinstance(error, DocumentTooLarge) or getattr(error, "code", None) in (10334, 17419)
+
+def store_pdf_text(pdf_hash, pdf_text):
+    """Saves a PDF's text (and retrieval index, if long) once per distinct file.
+
+    Counts a reference for the chat about to be created. Returns the PDF's
+    prompt context, or None if it cannot be stored.
+    """
+    pdf = {"text_zstd": compress_text(pdf_text)}
+    chunks = embeddings = None
+    if len(pdf_text) >= RETRIEVAL_MIN_CHARS:
+        try:
+            chunks = chunk_text(pdf_text)
+            embeddings = embed_texts(chunks, "retrieval_document")
+        except Exception as e:
+            # Without an index the full text is sent, as for short documents.
+            print(f"Error indexing PDF {pdf_hash}: {e}")
+            chunks = embeddings = None
+    if chunks:
+        # Chunks partition the text, so only their end offsets are stored;
+        # vectors are packed float32 to keep large indexes under 16 MB.
+        ends, offset = [], 0
+        for chunk in chunks:
+            offset += len(chunk)
+            ends.append(offset)
+        index = {
+            "chunk_ends": ends,
+            "embeddings_f32": embeddings.tobytes(),
+            "embedding_dim": int(embeddings.shape[1])
+        }
+    else:
+        index = {}
+    # If the index pushes the record past MongoDB's 16 MB limit, store the
+    # text alone; without an index the full text is sent, as for short documents.
+    for record in ([{**pdf, **index}, pdf] if index else [pdf]):
+        try:
+            # The new chat's reference is counted in the same write.
+            pdfs_collection.update_one(
+                {"_id": pdf_hash},
+                {"$setOnInsert": record, "$inc": {"refs": 1}},
+                upsert=True
+            )
+            break
+        except (DocumentTooLarge, WriteError) as e:
+            if not _is_too_large(e):
+                raise
+            print(f"PDF {pdf_hash} is too large to store ({len(record)} fields): {e}")
+    else:
+        return None
+    if record is pdf:
+        chunks = embeddings = None
+    pdf_context = build_pdf_context(pdf_text, chunks, embeddings, pdf_hash)
+    cache_pdf_context(pdf_hash, pdf_context)
+    return pdf_context
+
+# chat_id -> Future of the latest history write still in flight.
+_pending_history_writes = {}
+_pending_history_writes_lock = threading.Lock()
+
+def _finish_history_write(chat_id, future):
+    """Logs a failed background history write and stops tracking it."""
+    with _pending_history_writes_lock:
+        if _pending_history_writes.get(chat_id) is future:
+            del _pending_history_writes[chat_id]
+    error = future.exception()
+    if error is not None:
+        print(f"Error saving chat history: {error}")
+
+def save_chat_turn(chat_oid, user_question, bot_markdown):
+    """Appends a turn to a chat's history without blocking the caller."""
+    chat_id = str(chat_oid)
+    future = _history_writer.submit(
+        chats_collection.update_one,
+        {"_id": chat_oid},
+        {"$push": {"history": {"user": user_question, "bot_markdown": bot_markdown}}}
+    )
+    with _pending_history_writes_lock:
+        _pending_history_writes[chat_id] = future
+    future.add_done_callback(lambda f: _finish_history_write(chat_id, f))
+
+def wait_for_history_write(chat_id, timeout=5):
+    """Waits for this worker's in-flight history write for a chat, if any.
+
+    Reads that follow a turn too closely on another worker can still miss
+    the last turn; this only closes the gap within one process.
+    """
+    with _pending_history_writes_lock:
+        future = _pending_history_writes.get(chat_id)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            pass  # Logged by _finish_history_write
+
+def _cache_is_fresh(pdf_context):
+    """True if a PDF's context cache outlives the safety margin."""
+    return pdf_context["cache_expires_at"] - time.time() > CONTEXT_CACHE_MARGIN_SECONDS
+
+def get_context_cache(pdf_context):
+    """Returns the name of a live Gemini context cache for a PDF, or None.
+
+    Only stored PDFs sent in full and long enough to meet Gemini's minimum
+    are cached. Cache state is shared between workers via the pdfs record; an
+    expiring cache has its TTL extended, and a failed creation backs off.
+    """
+    doc_prompt = pdf_context["doc_prompt"]
+    pdf_hash = pdf_context["pdf_hash"]
+    if doc_prompt is None or pdf_hash is None or len(doc_prompt) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    if _cache_is_fresh(pdf_context):
+        return pdf_context["cache_name"]
+    if pdf_context["cache_retry_at"] > time.time():
+        return None
+
+    with pdf_context["cache_lock"]:
+        # Another thread, or another worker via the pdfs record, may have
+        # refreshed the cache or recorded a failure in the meantime.
+        if not _cache_is_fresh(pdf_context):
+            record = pdfs_collection.find_one(
+                {"_id": pdf_hash},
+                {"cached_content": 1, "cache_expires_at": 1, "cache_retry_at": 1}
+            )
+            _apply_cache_state(pdf_context, record or {})
+        if _cache_is_fresh(pdf_context):
+            return pdf_context["cache_name"]
+        if pdf_context["cache_retry_at"] > time.time():
+            return None
+
+        cache = None
+        if pdf_context["cache_name"]:
+            try:
+                cache = caching.CachedContent.get(pdf_context["cache_name"])
+                cache.update(ttl=CONTEXT_CACHE_TTL)
+            except Exception as e:
+                # Already expired or deleted; create a new one below.
+                print(f"Error extending context cache for PDF {pdf_hash}: {e}")
+                cache = None
+        if cache is None:
+            try:
+                cache = caching.CachedContent.create(
+                    model=GEMINI_MODEL,
+                    system_instruction=SYSTEM_PROMPT,
+                    contents=[doc_prompt],
+                    ttl=CONTEXT_CACHE_TTL
+                )
+            except Exception as e:
+                # Send the document with every turn until the retry time.
+                print(f"Error creating context cache for PDF {pdf_hash}: {e}")
+                retry_at = time.time() + CONTEXT_CACHE_RETRY_SECONDS
+                _apply_cache_state(pdf_context, {"cache_retry_at": retry_at})
+                pdfs_collection.update_one(
+                    {"_id": pdf_hash},
+                    {"$set": {"cache_retry_at": retry_at}, "$unset": {"cached_content": "", "cache_expires_at": ""}}
+                )
+                return None
+
+        expires_at = time.time() + CONTEXT_CACHE_TTL.total_seconds()
+        _apply_cache_state(pdf_context, {"cached_content": cache.name, "cache_expires_at": expires_at})
+        pdfs_collection.update_one(
+            {"_id": pdf_hash},
+            {"$set": {"cached_content": cache.name, "cache_expires_at": expires_at}, "$unset": {"cache_retry_at": ""}}
+        )
+        return cache.name
+
+def forget_context_cache(pdf_context):
+    """Drops a context cache Gemini no longer has (e.g. deleted by another worker).
+
+    Returns False if the context had no cache to drop.
+    """
+    with pdf_context["cache_lock"]:
+        cache_name = pdf_context["cache_name"]
+        if cache_name is None:
+            return False
+        _apply_cache_state(pdf_context, {})
+    if pdf_context["pdf_hash"] is not None:
+        pdfs_collection.update_one(
+            {"_id": pdf_context["pdf_hash"], "cached_content": cache_name},
+            {"$unset": {"cached_content": "", "cache_expires_at": ""}}
+        )
+    return True
+
+# chat_id -> (ChatSession, last_used, cache_name, approximate size)
+_chat_sessions = SizedLRUCache(CHAT_SESSION_CACHE_BYTES)
+
+def checkout_chat_session(chat_id, chat_history, pdf_context):
+    """Takes a chat's Gemini session out of the cache, building one if needed.
+
+    Returns the session, the name of the context cache it was built on and
+    its approximate size in characters.
+    """
+    cache_name = get_context_cache(pdf_context)
+    now = time.monotonic()
+    _chat_sessions.prune(lambda entry: now - entry[1] >= CHAT_SESSION_IDLE_SECONDS)
+    cached = _chat_sessions.pop(chat_id)
+
+    # A session that is behind the stored history (e.g. the last turn was
+    # answered by another worker) or built on a replaced context cache is
+    # rebuilt from MongoDB.
+    doc_prompt = pdf_context["doc_prompt"]
+    inline_doc = doc_prompt is not None and cache_name is None
+    base_length = 1 if inline_doc else 0
+    if cached is not None and cached[2] == cache_name:
+        try:
+            up_to_date = len(cached[0].history) >= base_length + 2 * len(chat_history)
+        except genai.types.BrokenResponseError:
+            up_to_date = False
+        if up_to_date:
+            return cached[0], cache_name, cached[3]
+    history = [{"role": "user", "parts": [doc_prompt]}] if inline_doc else []
+    size = len(doc_prompt) if inline_doc else 0
+    for entry in chat_history:
+        history.append({"role": "user", "parts": [entry["user"]]})
+        history.append({"role": "model", "parts": [entry["bot_markdown"]]})
+        size += len(entry["user"]) + len(entry["bot_markdown"])
+    if cache_name is None:
+        model = MODEL
+    else:
+        model = genai.GenerativeModel.from_cached_content(cached_content=cache_name)
+    return model.start_chat(history=history), cache_name, size
+
+def evict_chat_session(chat_id):
+    """Drops a chat's cached Gemini session."""
+    _chat_sessions.pop(chat_id)
+
+def checkin_chat_session(chat_id, session, cache_name, size):
+    """Returns a session to the cache after a completed turn.
+
+    `size` is kept up to date by the caller rather than recomputed from the
+    session history, which would copy an inline document on every turn.
+    """
+    _chat_sessions.put(chat_id, (session, time.monotonic(), cache_name, size), size)
+
+def _finished_normally(response):
+    """True if a fully streamed Gemini response ended with STOP."""
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest', system_instruction=system_prompt)
-        messages = [{"role": "user", "parts": [f"DOCUMENT TEXT:\n---\n{pdf_text}\n---"]}]
-        for entry in chat_history:
-            messages.append({"role": "user", "parts": [entry["user"]]})
-            messages.append({"role": "model", "parts": [entry["bot_markdown"]]})
-        messages.append({"role": "user", "parts": [user_question]})
-        response_stream = model.generate_content(messages, stream=True)
-        for chunk in response_stream:
-            if chunk.text:
-                yield f"data: {json.dumps({'text': chunk.text})}\n\n"
+        return response.candidates[0].finish_reason.name == "STOP"
+    except (AttributeError, IndexError):
+        return False
+
+def _stream_turn(chat_id, chat_history, user_question, pdf_context):
+    """Streams one Gemini turn as (text, encoded SSE frame) pairs."""
+    # The session is only checked back in once the stream completes, so a
+    # failed or abandoned turn never leaves a half-updated session cached.
+    session, cache_name, size = checkout_chat_session(chat_id, chat_history, pdf_context)
+    message = build_turn_message(pdf_context, user_question)
+    response_stream = session.send_message(message, stream=True)
+    size += len(user_question)
+    for chunk in response_stream:
+        if chunk.text:
+            size += len(chunk.text)
+            yield chunk.text, b"data: " + orjson.dumps({'text': chunk.text}) + b"\n\n"
+    # A turn cut short (e.g. MAX_TOKENS or SAFETY) leaves the session's
+    # history unusable, so it is dropped and rebuilt on the next turn.
+    if _finished_normally(response_stream):
+        if message is not user_question:
+            # Keep retrieved excerpts out of the session history so later
+            # turns don't resend them; only the question is remembered.
+            history = session.history
+            history[-2] = {"role": "user", "parts": [user_question]}
+            session.history = history
+        checkin_chat_session(chat_id, session, cache_name, size)
+
+def get_gemini_response_stream(chat_id, chat_history, user_question, pdf_context):
+    """Gets a streaming response from Gemini as (text, encoded SSE frame) pairs."""
+    try:
+        try:
+            yield from _stream_turn(chat_id, chat_history, user_question, pdf_context)
+        except NotFound:
+            # The context cache is gone despite its recorded expiry; forget it
+            # and answer once more with a new cache or the inline document.
+            if not forget_context_cache(pdf_context):
+                raise
+            yield from _stream_turn(chat_id, chat_history, user_question, pdf_context)
     except Exception as e:
         print(f"\n--- GEMINI API ERROR ---: {e}\n")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield "", b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
 
 # --- 3. API Routes ---
 
@@ -95,11 +747,15 @@ def register():
         return jsonify({"error": "Username already exists."}), 409
 
     hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-    user_id = users_collection.insert_one({
-        "username": username,
-        "password": hashed_password,
-        "created_at": datetime.datetime.now(datetime.timezone.utc)
-    }).inserted_id
+    try:
+        user_id = users_collection.insert_one({
+            "username": username,
+            "password": hashed_password,
+            "created_at": datetime.datetime.now(datetime.timezone.utc)
+        }).inserted_id
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration of the same username
+        return jsonify({"error": "Username already exists."}), 409
 
     return jsonify({"message": "User registered successfully.", "user_id": str(user_id)}), 201
 
@@ -131,7 +787,7 @@ def get_chat_list():
         return jsonify({"error": "User ID is required."}), 400
     
     try:
-        chats = chats_collection.find({"user_id": user_id}).sort("timestamp", -1)
+        chats = chats_collection.find({"user_id": user_id}, {"title": 1}).sort("timestamp", -1)
         session_list = [
             {"id": str(chat["_id"]), "title": chat["title"]} for chat in chats
         ]
@@ -147,10 +803,11 @@ def handle_single_chat(chat_id):
     try:
         # Convert string ID to MongoDB ObjectId
         obj_id = ObjectId(chat_id)
-    except Exception:
+    except (InvalidId, TypeError):
         return jsonify({"error": "Invalid chat ID format."}), 400
 
     if request.method == 'GET':
+        wait_for_history_write(chat_id)
         chat = chats_collection.find_one({"_id": obj_id})
         if chat:
             chat['_id'] = str(chat['_id']) # Convert ObjectId to string for JSON
@@ -158,8 +815,10 @@ def handle_single_chat(chat_id):
         return jsonify({"error": "Chat not found"}), 404
     
     if request.method == 'DELETE':
-        result = chats_collection.delete_one({"_id": obj_id})
-        if result.deleted_count > 0:
+        chat = chats_collection.find_one_and_delete({"_id": obj_id}, projection={"pdf_hash": 1})
+        if chat:
+            evict_chat_session(chat_id)
+            release_pdf_ref(chat.get("pdf_hash"))
             return jsonify({"message": "Chat deleted successfully."}), 200
         return jsonify({"error": "Chat not found"}), 404
 
@@ -171,8 +830,15 @@ def delete_all_chats():
         return jsonify({"error": "User ID is required."}), 400
     
     try:
-        result = chats_collection.delete_many({"user_id": user_id})
-        return jsonify({"message": f"Deleted {result.deleted_count} chats."}), 200
+        # Chats are deleted one at a time so that each PDF reference is
+        # released only by the request that actually deleted the chat.
+        deleted_count = 0
+        for chat in chats_collection.find({"user_id": user_id}, {"pdf_hash": 1}):
+            if chats_collection.delete_one({"_id": chat["_id"]}).deleted_count:
+                deleted_count += 1
+                evict_chat_session(str(chat["_id"]))
+                release_pdf_ref(chat.get("pdf_hash"))
+        return jsonify({"message": f"Deleted {deleted_count} chats."}), 200
     except Exception as e:
         print(f"Error deleting all chats for user {user_id}: {e}")
         return jsonify({"error": "Could not clear chat history."}), 500
@@ -195,45 +861,71 @@ def handle_chat():
             if 'pdf_file' not in request.files:
                 return jsonify({"error": "A PDF file is required for a new chat."}), 400
             
+            # Spool the upload to disk once and let MuPDF read it from there,
+            # so the PDF is never held in memory as a Python bytes object.
             file = request.files['pdf_file']
-            file_content = file.read()
-            pdf_text = extract_pdf_text(file_content)
-            if pdf_text is None: return jsonify({"error": "Failed to read PDF."}), 500
+            fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
+            os.close(fd)
+            try:
+                file.save(tmp_path)
+                pdf_hash = hash_pdf_file(tmp_path)
+                # The pdfs record is checked even when this worker has the
+                # context cached, since another worker may have purged it.
+                pdf_context = get_pdf_context(pdf_hash) if acquire_pdf_ref(pdf_hash) else None
+                if pdf_context is None:
+                    evict_pdf_context(pdf_hash)
+                    pdf_text = extract_pdf_text(tmp_path)
+                    if pdf_text is not None:
+                        pdf_context = store_pdf_text(pdf_hash, pdf_text)
+            finally:
+                os.remove(tmp_path)
+            if pdf_context is None: return jsonify({"error": "Failed to read PDF."}), 500
 
             new_chat = {
                 "user_id": user_id,
                 "title": user_question[:40] + "...",
                 "timestamp": datetime.datetime.now(datetime.timezone.utc),
-                "pdf_text": pdf_text,
+                "pdf_hash": pdf_hash,
                 "history": []
             }
             result = chats_collection.insert_one(new_chat)
-            chat_id = str(result.inserted_id)
+            chat_oid = result.inserted_id
+            chat_id = str(chat_oid)
             chat_data = new_chat
         else:
-            # Load existing chat
-            chat_data = chats_collection.find_one({"_id": ObjectId(chat_id), "user_id": user_id})
+            # Load existing chat; older chats still embed pdf_text directly
+            try:
+                chat_oid = ObjectId(chat_id)
+            except (InvalidId, TypeError):
+                return jsonify({"error": "Invalid chat ID format."}), 400
+            # The timestamp is bumped in the same round trip, so the chat list
+            # already shows this chat first when the stream ends.
+            wait_for_history_write(chat_id)
+            chat_data = chats_collection.find_one_and_update(
+                {"_id": chat_oid, "user_id": user_id},
+                {"$set": {"timestamp": datetime.datetime.now(datetime.timezone.utc)}},
+                projection={"user_id": 1, "history": 1, "pdf_hash": 1, "pdf_text": 1}
+            )
             if not chat_data:
                 return jsonify({"error": "Chat not found or access denied."}), 404
+            if "pdf_hash" in chat_data:
+                pdf_context = get_pdf_context(chat_data["pdf_hash"])
+            elif "pdf_text" in chat_data:
+                pdf_context = build_pdf_context(chat_data["pdf_text"])
+            else:
+                pdf_context = None
+            if pdf_context is None:
+                return jsonify({"error": "The PDF for this chat is no longer available."}), 404
         
         def generate_response():
             full_bot_response = ""
-            for chunk in get_gemini_response_stream(chat_data.get("history", []), user_question, chat_data["pdf_text"]):
-                yield chunk
-                try:
-                    data_str = chunk.split('data: ')[1]
-                    data = json.loads(data_str)
-                    if 'text' in data:
-                        full_bot_response += data['text']
-                except (IndexError, json.JSONDecodeError):
-                    pass
+            for text, frame in get_gemini_response_stream(chat_id, chat_data.get("history", []), user_question, pdf_context):
+                full_bot_response += text
+                yield frame
             
-            # After streaming, update the history in MongoDB
-            chats_collection.update_one(
-                {"_id": ObjectId(chat_id)},
-                {"$push": {"history": {"user": user_question, "bot_markdown": full_bot_response}}}
-            )
-            yield f"data: {json.dumps({'end_of_stream': True, 'chat_id': chat_id})}\n\n"
+            # After streaming, update the history in MongoDB in the background
+            save_chat_turn(chat_oid, user_question, full_bot_response)
+            yield b"data: " + orjson.dumps({'end_of_stream': True, 'chat_id': chat_id}) + b"\n\n"
 
         return Response(generate_response(), mimetype='text/event-stream')
     except Exception as e:
@@ -0,0 +1,16 @@
+# --- Gunicorn Configuration (Production) ---
+# Run with: gunicorn -c gunicorn_conf.py app:app
+# gevent workers let each process hold many long-lived SSE streams at once.
+
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = multiprocessing.cpu_count() * 2 + 1
+# Each worker has its own PDF extraction pool. With 2*cpu+1 workers already
+# covering the CPUs, every pool gets a single process, so parallel page-range
+# extraction only applies to standalone runs (python app.py).
+os.environ.setdefault("PDF_POOL_WORKERS", "1")
+worker_class = "gevent"
+worker_connections = 1000
+timeout = 120
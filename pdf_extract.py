@@ -0,0 +1,20 @@
+# --- PDF Text Extraction Worker ---
+# Runs inside the extraction process pool. Kept separate from app.py so pool
+# processes never import the web app (MongoDB client, Gemini model, executors).
+
+import fitz  # PyMuPDF
+
+# Plain-text extraction without dehyphenation. Characters outside a page's
+# mediabox are still clipped, so off-page or hidden text isn't sent to Gemini.
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_MEDIABOX_CLIP
+
+def extract_page_range(pdf_path, start, stop):
+    """Extracts the text of pages [start, stop) of a PDF file on disk."""
+    pdf_document = fitz.open(pdf_path, filetype="pdf")
+    try:
+        return "".join(
+            pdf_document[page_number].get_text("text", flags=PDF_TEXT_FLAGS, sort=False)
+            for page_number in range(start, stop)
+        )
+    finally:
+        pdf_document.close()